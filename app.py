@@ -1,36 +1,244 @@
-from flask import Flask, request, jsonify, redirect
-from flask_cors import CORS
+from flask import Flask, request, jsonify
 from cryptography.fernet import Fernet, InvalidToken
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+import base64
+import collections
+import functools
+import hmac
 import os
 import logging
+import string
 
-logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+import orjson
+
+try:
+    # Rust 実装の Fernet（入っていれば優先して使う。無ければ cryptography にフォールバック）
+    import rfernet
+except ImportError:
+    rfernet = None
+
+# LOG_LEVEL=WARNING などにするとリクエストごとの INFO ログを丸ごと省ける
+# （不明な値で起動失敗しないよう、知らないレベル名は INFO 扱いにする）
+_LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
+_LOG_LEVEL_VALID = _LOG_LEVEL in logging.getLevelNamesMapping()
+logging.basicConfig(
+    level=_LOG_LEVEL if _LOG_LEVEL_VALID else "INFO",
+    format="%(asctime)s %(levelname)s %(message)s",
+)
 logger = logging.getLogger("encryption-api")
+if not _LOG_LEVEL_VALID:
+    logger.warning("Unknown LOG_LEVEL %r, falling back to INFO", _LOG_LEVEL)
+# ホットパスでは isEnabledFor を毎回呼ばず、起動時に判定した値だけを見る
+_LOG_INFO = logger.isEnabledFor(logging.INFO)
 
 app = Flask(__name__)
-CORS(app)
+
+# CORS は全オリジン許可のみなので、flask-cors を使わず固定のヘッダーを付ける
+_CORS_HEADERS = (("Access-Control-Allow-Origin", "*"),)
+_CORS_PREFLIGHT_HEADERS = (
+    ("Access-Control-Allow-Methods", "GET, POST, OPTIONS"),
+    ("Access-Control-Max-Age", "86400"),
+)
+
+
+@app.after_request
+def add_cors_headers(resp):
+    resp.headers.extend(_CORS_HEADERS)
+    if request.method == "OPTIONS":
+        # プリフライト: Flask が自動で返す OPTIONS 応答に許可メソッド・ヘッダーを足す
+        resp.headers.extend(_CORS_PREFLIGHT_HEADERS)
+        resp.headers["Access-Control-Allow-Headers"] = request.headers.get(
+            "Access-Control-Request-Headers", "Content-Type"
+        )
+    return resp
+
+
+class _RustFernet:
+    """rfernet.Fernet を cryptography の Fernet と同じ bytes ベースの API で包む。"""
+
+    def __init__(self, key_str):
+        self._fernet = rfernet.Fernet(key_str)
+
+    def encrypt(self, data):
+        return self._fernet.encrypt(data).encode()
+
+    def decrypt(self, token):
+        try:
+            return self._fernet.decrypt(token.decode())
+        except rfernet.DecryptionError:
+            raise InvalidToken from None
+
+
+# Fernet の IV (16 bytes) を os.urandom でまとめて取っておくプール
+# （1 回の getrandom で 4096 個分。暗号化ごとのシステムコールを避ける）
+_IV_BATCH = 4096
+_iv_pool = collections.deque()
+# fork 後の子プロセスが親と同じ IV を使わないよう、プールは子側で必ず捨てる
+os.register_at_fork(after_in_child=_iv_pool.clear)
+
+
+def _next_iv():
+    """プールから未使用の IV を 1 つ取り出す（空なら補充する）。"""
+    try:
+        return _iv_pool.popleft()
+    except IndexError:
+        buf = os.urandom(16 * _IV_BATCH)
+        _iv_pool.extend(buf[i:i + 16] for i in range(16, len(buf), 16))
+        return buf[:16]
+
+
+class _FastFernet(Fernet):
+    """
+    暗号化だけを AES-128-CBC + HMAC-SHA256 の部品から直接組み立てる Fernet。
+    トークンは通常の Fernet と同一形式（復号は Fernet のまま）。IV は _next_iv() から取る。
+    """
+
+    def __init__(self, key):
+        super().__init__(key)
+        raw_key = base64.urlsafe_b64decode(key)
+        self._hmac_key = raw_key[:16]
+        self._aes = algorithms.AES(raw_key[16:])
+
+    def encrypt_at_time(self, data, current_time):
+        iv = _next_iv()
+        # PKCS7 パディング（padder オブジェクトを作らずに直接付ける）
+        pad = 16 - len(data) % 16
+        encryptor = Cipher(self._aes, modes.CBC(iv)).encryptor()
+        ciphertext = encryptor.update(data + bytes((pad,)) * pad) + encryptor.finalize()
+        basic_parts = b"\x80" + current_time.to_bytes(8, "big") + iv + ciphertext
+        tag = hmac.digest(self._hmac_key, basic_parts, "sha256")
+        return base64.urlsafe_b64encode(basic_parts + tag)
+
+
+# 注意: rfernet は requirements.txt の必須依存なので、Render 上では常に _RustFernet が使われる。
+# _FastFernet と IV プールは rfernet が入っていない環境でのフォールバックで、本番では動かない。
+@functools.lru_cache(maxsize=1)
+def _build_cipher(key_str):
+    """鍵文字列から Fernet インスタンスを生成する（同じ鍵なら再利用）。"""
+    # Render の Environment には str を入れる想定
+    if rfernet is not None:
+        return _RustFernet(key_str)
+    return _FastFernet(key_str.encode())
 
 
-def get_cipher():
-    """環境変数から鍵を取得して Fernet インスタンスを返す。"""
+def initialize_cipher():
+    """環境変数から鍵を取得して (Fernet インスタンス, エラー) を返す。"""
     key = os.environ.get("FERNET_KEY")
     if not key:
         return None, "FERNET_KEY is not set"
     try:
-        # Render の Environment には str を入れる想定
-        return Fernet(key.encode()), None
+        return _build_cipher(key), None
     except Exception as e:
         return None, f"Invalid FERNET_KEY: {e}"
 
 
+# 起動時に一度だけ鍵を解決し、リクエストごとの Fernet 生成を避ける
+CIPHER, CIPHER_ERROR = initialize_cipher()
+# ホットパスで属性参照をしないよう、メソッドも先に束縛しておく（鍵を差し替えるなら再束縛すること）
+_ENCRYPT = CIPHER.encrypt if CIPHER is not None else None
+_DECRYPT = CIPHER.decrypt if CIPHER is not None else None
+
+# /prefill で同じ raw の暗号化結果を再利用する件数（既定 0 = キャッシュ無効、毎回新しいトークン）
+_PREFILL_CACHE_SIZE = int(os.environ.get("PREFILL_CACHE_SIZE", "0"))
+
+
+@functools.lru_cache(maxsize=_PREFILL_CACHE_SIZE)
+def _encrypt_cached(raw_b):
+    """
+    /prefill 用: raw (bytes) を暗号化したトークン (bytes) を返す。
+    キャッシュはワーカープロセスごとで、fork・追い出し・再起動で失われるため、
+    同じ raw でもワーカーや時期によって別のトークンになる（安定した識別子ではない）。
+    一方でキャッシュに残っている間は同じトークンが返るので、同じ raw かどうかが
+    トークンの一致から分かってしまう。有効にする場合はこの点を許容できるときだけにすること。
+    """
+    return _ENCRYPT(raw_b)
+
+
+# RawID に使える文字（英数字と "-" / "_"）。bytes.translate で除去して残りがあれば不正
+_RAWID_ALLOWED = (string.ascii_letters + string.digits + "-_").encode("ascii")
+
+
+def _check_raw_id(raw):
+    """RawID を検証し、(暗号化に渡す ASCII bytes, エラーメッセージ) を返す。"""
+    if not raw:
+        return None, "RawID is required"
+    if not isinstance(raw, str):
+        return None, "RawID must be a string"
+    try:
+        raw_b = raw.encode("ascii")
+    except UnicodeEncodeError:
+        return None, "RawID contains invalid characters"
+    if len(raw_b) > 256:
+        return None, "RawID too long"
+    if raw_b.translate(None, _RAWID_ALLOWED):
+        return None, "RawID contains invalid characters"
+    return raw_b, None
+
+
+def _read_json():
+    """
+    リクエストボディを orjson で読む。空・不正な JSON・オブジェクト以外は {} 扱い
+    （get_json(silent=True) or {} と同じく、後続の必須チェックで 400 になる）。
+    """
+    body = request.get_data(cache=False)
+    if not body:
+        return {}
+    try:
+        data = orjson.loads(body)
+    except orjson.JSONDecodeError:
+        return {}
+    return data if isinstance(data, dict) else {}
+
+
+def _json_response(payload, status=200):
+    """orjson で直接 bytes にシリアライズした JSON レスポンスを返す。"""
+    return app.response_class(orjson.dumps(payload), status=status, mimetype="application/json")
+
+
+@functools.lru_cache(maxsize=None)
+def _error_body(message):
+    """エラーメッセージの JSON ボディ（メッセージは固定の文字列だけなので件数は有限）。"""
+    return orjson.dumps({"error": message})
+
+
+def _error_response(message, status):
+    """固定メッセージのエラーレスポンス。ボディは初回だけシリアライズして使い回す。"""
+    return app.response_class(_error_body(message), status=status, mimetype="application/json")
+
+
+# 内容が固定のレスポンスボディは起動時に一度だけシリアライズしておく
+_ROOT_BODY = orjson.dumps({"name": "encryption-api", "status": "ok"})
+_HEALTH_BODY = orjson.dumps({"status": "healthy"})
+
+
 @app.get("/")
 def root():
-    return jsonify({"name": "encryption-api", "status": "ok"})
+    return app.response_class(_ROOT_BODY, mimetype="application/json")
 
 
 @app.get("/health")
 def health():
-    return jsonify({"status": "healthy"})
+    return app.response_class(_HEALTH_BODY, mimetype="application/json")
+
+
+# ロードバランサーからの GET /health は Flask のルーティングを通さず WSGI 層で直接返す
+_HEALTH_WSGI_BODY = [_HEALTH_BODY]
+_HEALTH_WSGI_HEADERS = [
+    ("Content-Type", "application/json"),
+    ("Content-Length", str(len(_HEALTH_BODY))),
+    *_CORS_HEADERS,
+]
+_flask_wsgi_app = app.wsgi_app
+
+
+def _fast_health_wsgi_app(environ, start_response):
+    if environ.get("PATH_INFO") == "/health" and environ.get("REQUEST_METHOD") == "GET":
+        start_response("200 OK", _HEALTH_WSGI_HEADERS)
+        return _HEALTH_WSGI_BODY
+    return _flask_wsgi_app(environ, start_response)
+
+
+app.wsgi_app = _fast_health_wsgi_app
 
 
 @app.post("/encrypt")
@@ -38,22 +246,53 @@ def encrypt():
     """
     入力: {"RawID": "<平文ID>"} -> 出力: {"SurveyID": "<暗号トークン>", "status": "success"}
     """
-    cipher, err = get_cipher()
-    if err:
-        return jsonify({"error": err}), 500
+    if CIPHER is None:
+        return _error_response(CIPHER_ERROR, 500)
 
-    data = request.get_json(silent=True) or {}
+    data = _read_json()
     raw = data.get("RawID")
-    if not raw:
-        return jsonify({"error": "RawID is required"}), 400
-    if not isinstance(raw, str):
-        return jsonify({"error": "RawID must be a string"}), 400
-    if len(raw) > 256:
-        return jsonify({"error": "RawID too long"}), 400
+    raw_b, err = _check_raw_id(raw)
+    if err:
+        return _error_response(err, 400)
+
+    token = _ENCRYPT(raw_b)
+    if _LOG_INFO:
+        logger.info("Encrypted RawID (len=%d) -> token (len=%d)", len(raw), len(token))
+    # Fernet トークンは URL-safe base64（エスケープ不要）なので bytes のまま JSON に埋め込む
+    body = b'{"SurveyID":"' + token + b'","status":"success"}'
+    return app.response_class(body, mimetype="application/json")
+
 
-    token = cipher.encrypt(raw.encode()).decode()
-    logger.info("Encrypted RawID (len=%d) -> token (len=%d)", len(raw), len(token))
-    return jsonify({"SurveyID": token, "status": "success"})
+@app.post("/encrypt-batch")
+def encrypt_batch():
+    """
+    入力: {"RawIDs": ["<平文ID>", ...]} -> 出力: {"SurveyIDs": ["<暗号トークン>", ...], "status": "success"}
+    - 一括処理用。1 リクエストあたり最大 1000 件、結果は入力と同じ順序
+    """
+    if CIPHER is None:
+        return _error_response(CIPHER_ERROR, 500)
+
+    data = _read_json()
+    raws = data.get("RawIDs")
+    if not raws:
+        return _error_response("RawIDs is required", 400)
+    if not isinstance(raws, list):
+        return _error_response("RawIDs must be a list", 400)
+    if len(raws) > 1000:
+        return _error_response("Too many RawIDs", 400)
+
+    raw_bs = []
+    for i, raw in enumerate(raws):
+        raw_b, err = _check_raw_id(raw)
+        if err:
+            return _json_response({"error": f"RawIDs[{i}]: {err}"}, 400)
+        raw_bs.append(raw_b)
+
+    enc = _ENCRYPT
+    tokens = [enc(raw_b).decode("ascii") for raw_b in raw_bs]
+    if _LOG_INFO:
+        logger.info("Encrypted %d RawIDs in batch", len(tokens))
+    return _json_response({"SurveyIDs": tokens, "status": "success"})
 
 
 @app.post("/decrypt")
@@ -61,24 +300,24 @@ def decrypt():
     """
     入力: {"SurveyID": "<暗号トークン>"} -> 出力: {"RawID": "<平文ID>", "status": "success"}
     """
-    cipher, err = get_cipher()
-    if err:
-        return jsonify({"error": err}), 500
+    if CIPHER is None:
+        return _error_response(CIPHER_ERROR, 500)
 
-    data = request.get_json(silent=True) or {}
+    data = _read_json()
     survey = data.get("SurveyID")
     if not survey:
-        return jsonify({"error": "SurveyID is required"}), 400
+        return _error_response("SurveyID is required", 400)
     if not isinstance(survey, str):
-        return jsonify({"error": "SurveyID must be a string"}), 400
+        return _error_response("SurveyID must be a string", 400)
 
     try:
-        raw = cipher.decrypt(survey.encode()).decode()
+        raw = _DECRYPT(survey.encode()).decode()
     except InvalidToken:
-        return jsonify({"error": "Invalid or corrupted SurveyID"}), 400
+        return _error_response("Invalid or corrupted SurveyID", 400)
 
-    logger.info("Decrypted token (len=%d) -> RawID (len=%d)", len(survey), len(raw))
-    return jsonify({"RawID": raw, "status": "success"})
+    if _LOG_INFO:
+        logger.info("Decrypted token (len=%d) -> RawID (len=%d)", len(survey), len(raw))
+    return _json_response({"RawID": raw, "status": "success"})
 
 
 @app.get("/generate-key")
@@ -87,6 +326,12 @@ def generate_key():
     return jsonify({"FERNET_KEY": Fernet.generate_key().decode()})
 
 
+@functools.lru_cache(maxsize=64)
+def _split_template(template):
+    """template を "ID" で分割した結果をキャッシュする（件数上限つき）。"""
+    return tuple(template.split("ID"))
+
+
 @app.get("/prefill")
 def prefill():
     """
@@ -104,24 +349,26 @@ def prefill():
     tx = request.args.get("tx")  # 任意（ログ用）
 
     if not raw or not template:
-        return jsonify({"error": "raw and template are required"}), 400
+        return _error_response("raw and template are required", 400)
     if len(raw) > 256:
-        return jsonify({"error": "raw too long"}), 400
+        return _error_response("raw too long", 400)
 
-    cipher, err = get_cipher()
-    if err:
-        return jsonify({"error": err}), 500
+    if CIPHER is None:
+        return _error_response(CIPHER_ERROR, 500)
 
-    token = cipher.encrypt(raw.encode()).decode()
+    token = _encrypt_cached(raw.encode()).decode()
 
     # Power Apps 側で EncodeUrl 済みの template に対して "ID" を文字列置換
-    filled = template.replace("ID", token)
+    # （分割結果をキャッシュし、token で join する = str.replace と同じ結果）
+    filled = token.join(_split_template(template))
 
-    logger.info("prefill tx=%s raw_len=%d token_len=%d", tx, len(raw), len(token))
-    return redirect(filled, code=302)
+    if _LOG_INFO:
+        logger.info("prefill tx=%s raw_len=%d token_len=%d", tx, len(raw), len(token))
+    # redirect() は HTML の本文を組み立てるので使わず、Location だけの 302 を直接返す
+    return app.response_class(b"", status=302, headers=(("Location", filled),))
 
 
-# ローカル実行用（Render では gunicorn が使われます）
+# ローカル実行用（Render では gunicorn + gevent ワーカーが使われます）
 if __name__ == "__main__":
     port = int(os.environ.get("PORT", "5000"))
     app.run(host="0.0.0.0", port=port, debug=True)
@@ -0,0 +1,20 @@
+# gunicorn の設定（Render の startCommand から読み込む）
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '5000')}"
+
+# gevent ワーカー: 1 ワーカーがイベントループで多数の接続をまとめて捌く
+# （リクエストごとにワーカーを占有しない）
+worker_class = "gevent"
+workers = int(os.environ.get("WEB_CONCURRENCY", "4"))
+worker_connections = 1000
+
+# keep-alive の待ち時間を既定の 2 秒から 5 秒に延ばす
+# （前段の Render のプロキシからの接続が、リクエストの合間に閉じられず使い回されるようにし、
+#   accept / 接続確立のやり直しを減らす）
+keepalive = 5
+
+# マスターで app を一度だけ読み込み（Fernet の生成もここで済む）、ワーカーは fork で共有する
+# （copy-on-write によりワーカーごとの暗号ライブラリ分のメモリを節約）
+# IV プールは fork 後に子プロセス側で破棄されるので、ワーカー間で IV が重複することはない
+preload_app = True